@@ -1,20 +1,50 @@
 """Export all matched flight emails to a readable text file for verification."""
 
-import base64
 import csv
 import os
-import re
+import shelve
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from bs4 import BeautifulSoup
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+# The cache file, fetching and body extraction come from scanner.py, so both scripts
+# read the same cache and share one retry/error policy
+from scanner import BATCH_SIZE, CACHE_FILE, MAX_WORKERS, fetch_messages, get_message_body, thread_service
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+REPORT_HEADERS = frozenset(("From", "To", "Date", "Subject"))
+
+# Report blocks, each rendered and written with a single call per flight
+ROW_TEMPLATE = (
+    "\n"
+    "{sep}\n"
+    "FLIGHT #{i}\n"
+    "{sep}\n"
+    "  Date:          {date}\n"
+    "  Airline:       {airline}\n"
+    "  Flight Number: {flight_number}\n"
+    "  From:          {origin}\n"
+    "  To:            {destination}\n"
+    "  PNR:           {pnr}\n"
+    "  Email Subject: {subject}\n"
+    "  Email Date:    {email_date}\n"
+    "\n"
+)
+HEADERS_TEMPLATE = (
+    "  --- EMAIL HEADERS ---\n"
+    "  From:    {From}\n"
+    "  To:      {To}\n"
+    "  Date:    {Date}\n"
+    "  Subject: {Subject}\n"
+    "\n"
+    "  --- EMAIL BODY ---\n"
+)
+
 
 def authenticate():
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -23,135 +53,115 @@ def authenticate():
             creds.refresh(Request())
         else:
             raise SystemExit("No valid token.json found. Run scanner.py first.")
-    return build("gmail", "v1", credentials=creds)
-
-
-def get_body(payload):
-    plain, html = "", ""
-    mime = payload.get("mimeType", "")
-    if mime == "text/plain":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            plain = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif mime == "text/html":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            html = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif "parts" in payload:
-        for part in payload["parts"]:
-            p, h = _extract_parts(part)
-            plain += p
-            html += h
-    if plain:
-        return plain
-    if html:
-        return BeautifulSoup(html, "html.parser").get_text(separator=" ", strip=True)
-    return "(no body)"
-
-
-def _extract_parts(part):
-    plain, html = "", ""
-    mime = part.get("mimeType", "")
-    if mime == "text/plain":
-        data = part.get("body", {}).get("data", "")
-        if data:
-            plain = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif mime == "text/html":
-        data = part.get("body", {}).get("data", "")
-        if data:
-            html = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif "parts" in part:
-        for sub in part["parts"]:
-            p, h = _extract_parts(sub)
-            plain += p
-            html += h
-    return plain, html
-
-
-def search_email(service, row):
-    """Search for the email matching this flight row."""
-    pnr = row["PNR/Booking Ref"].strip()
-    subject = row["Email Subject"].strip()
-
-    # Try PNR search first (most unique)
+    return creds
+
+
+def build_queries(pnr, subject):
+    """Gmail queries that locate the email for a flight row, most specific first."""
+    queries = []
+    pnr = pnr.strip()
+    subject = subject.strip()
+
+    # PNR search first (most unique)
     if pnr:
-        result = service.users().messages().list(userId="me", q=pnr, includeSpamTrash=True).execute()
-        msgs = result.get("messages", [])
-        if msgs:
-            return msgs[0]["id"]
+        queries.append(pnr)
 
     # Fallback: search by subject
     if subject:
         # Use first 60 chars of subject, escape quotes
         q = subject[:60].replace('"', '\\"')
-        result = service.users().messages().list(userId="me", q=f'subject:"{q}"', includeSpamTrash=True).execute()
+        queries.append(f'subject:"{q}"')
+
+    return tuple(queries)
+
+
+def search_email(service, queries):
+    """Return the ID of the first message matched by the queries, tried in order."""
+    for q in queries:
+        result = service.users().messages().list(userId="me", q=q, includeSpamTrash=True).execute()
         msgs = result.get("messages", [])
         if msgs:
             return msgs[0]["id"]
-
     return None
 
 
 def main():
     print("Exporting flight emails for verification...")
-    service = authenticate()
+    creds = authenticate()
 
     rows = []
     with open("flights.csv", "r") as f:
-        rows = list(csv.DictReader(f))
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            print("Found 0 flights in CSV")
+            return
+        # Resolve column positions once; rows stay plain lists
+        col = {name: i for i, name in enumerate(header)}
+        rows = list(reader)
 
     print(f"Found {len(rows)} flights in CSV\n")
 
-    output_lines = []
-    output_lines.append("=" * 80)
-    output_lines.append("FLIGHT EMAILS - VERIFICATION EXPORT")
-    output_lines.append(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-    output_lines.append(f"Total flights: {len(rows)}")
-    output_lines.append("=" * 80)
-
-    for i, row in enumerate(rows, 1):
-        print(f"  Fetching {i}/{len(rows)}: {row['Date']} {row['Airline']} {row['PNR/Booking Ref']}...")
-
-        output_lines.append("")
-        output_lines.append(f"{'─' * 80}")
-        output_lines.append(f"FLIGHT #{i}")
-        output_lines.append(f"{'─' * 80}")
-        output_lines.append(f"  Date:          {row['Date']}")
-        output_lines.append(f"  Airline:       {row['Airline']}")
-        output_lines.append(f"  Flight Number: {row['Flight Number']}")
-        output_lines.append(f"  From:          {row['From']}")
-        output_lines.append(f"  To:            {row['To']}")
-        output_lines.append(f"  PNR:           {row['PNR/Booking Ref']}")
-        output_lines.append(f"  Email Subject: {row['Email Subject'].strip()}")
-        output_lines.append(f"  Email Date:    {row['Email Date']}")
-        output_lines.append("")
-
-        msg_id = search_email(service, row)
-        if msg_id:
-            msg = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
-            payload = msg.get("payload", {})
-            headers = {h["name"]: h["value"] for h in payload.get("headers", [])}
-
-            output_lines.append(f"  --- EMAIL HEADERS ---")
-            output_lines.append(f"  From:    {headers.get('From', 'N/A')}")
-            output_lines.append(f"  To:      {headers.get('To', 'N/A')}")
-            output_lines.append(f"  Date:    {headers.get('Date', 'N/A')}")
-            output_lines.append(f"  Subject: {headers.get('Subject', 'N/A')}")
-            output_lines.append("")
-            output_lines.append(f"  --- EMAIL BODY ---")
-
-            body = get_body(payload)
-            # Trim very long bodies to 2000 chars
-            if len(body) > 2000:
-                body = body[:2000] + "\n  ... [TRUNCATED] ..."
-            for line in body.split("\n"):
-                output_lines.append(f"  {line}")
-        else:
-            output_lines.append("  [EMAIL NOT FOUND]")
+    # Build every query up front so the worker threads only do I/O; rows sharing
+    # the same queries are looked up once
+    row_queries = [build_queries(row[col["PNR/Booking Ref"]], row[col["Email Subject"]]) for row in rows]
+    unique_queries = list(dict.fromkeys(row_queries))
+    found = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(lambda queries: search_email(thread_service(creds), queries), unique_queries)
+        for i, (queries, msg_id) in enumerate(zip(unique_queries, results), 1):
+            print(f"  Searched {i}/{len(unique_queries)}: {' / '.join(queries)}...")
+            found[queries] = msg_id
+    msg_ids = [found[queries] for queries in row_queries]
 
     output_file = "flight_emails_verification.txt"
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write("\n".join(output_lines))
+    # Stream the report to a buffered file, holding only one batch of fetched emails at a time
+    with open(output_file, "w", encoding="utf-8", buffering=1 << 20) as f, shelve.open(CACHE_FILE) as cache:
+        f.write("=" * 80 + "\n")
+        f.write("FLIGHT EMAILS - VERIFICATION EXPORT\n")
+        f.write(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
+        f.write(f"Total flights: {len(rows)}\n")
+        f.write("=" * 80 + "\n")
+
+        for start in range(0, len(rows), BATCH_SIZE):
+            chunk = list(zip(rows[start:start + BATCH_SIZE], msg_ids[start:start + BATCH_SIZE]))
+            unique_ids = list(dict.fromkeys(mid for _, mid in chunk if mid))
+            print(f"\nFetching {len(unique_ids)} matched emails for flights {start + 1}-{start + len(chunk)}...")
+            fetched = fetch_messages(creds, unique_ids, cache=cache, format="full")
+
+            for i, (row, msg_id) in enumerate(chunk, start + 1):
+                f.write(ROW_TEMPLATE.format(
+                    sep="─" * 80,
+                    i=i,
+                    date=row[col["Date"]],
+                    airline=row[col["Airline"]],
+                    flight_number=row[col["Flight Number"]],
+                    origin=row[col["From"]],
+                    destination=row[col["To"]],
+                    pnr=row[col["PNR/Booking Ref"]],
+                    subject=row[col["Email Subject"]].strip(),
+                    email_date=row[col["Email Date"]],
+                ))
+
+                msg = fetched.get(msg_id)
+                if msg:
+                    payload = msg.get("payload", {})
+                    headers = {h["name"]: h["value"] for h in payload.get("headers", []) if h["name"] in REPORT_HEADERS}
+                    f.write(HEADERS_TEMPLATE.format(
+                        From=headers.get("From", "N/A"),
+                        To=headers.get("To", "N/A"),
+                        Date=headers.get("Date", "N/A"),
+                        Subject=headers.get("Subject", "N/A"),
+                    ))
+
+                    body = get_message_body(payload) or "(no body)"
+                    # Trim very long bodies to 2000 chars
+                    if len(body) > 2000:
+                        body = body[:2000] + "\n  ... [TRUNCATED] ..."
+                    # Indent every body line in one write
+                    f.write("  " + body.replace("\n", "\n  ") + "\n")
+                else:
+                    f.write("  [EMAIL NOT FOUND]\n")
 
     print(f"\nDone! Saved to {output_file}")
     print(f"Open it with: open {output_file}")
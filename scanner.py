@@ -1,19 +1,47 @@
 """Gmail Flight Scanner - Scans Gmail for flight emails and exports details to CSV."""
 
-import base64
+import asyncio
 import csv
 import os
 import re
+import shelve
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
 
-from bs4 import BeautifulSoup
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import ahocorasick
+import pybase64
+from lxml import etree
+from googleapiclient.errors import HttpError
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# Gmail batch endpoint accepts up to 100 calls per HTTP request
+BATCH_SIZE = 100
+# messages.list page size: the API maximum (the default is 100)
+LIST_PAGE_SIZE = 500
+# Per-message batch errors worth retrying individually (rate limits, server errors)
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Worker threads for the per-message fallback fetches
+MAX_WORKERS = 8
+# Passes of per-message retries, waiting RETRY_BACKOFF seconds before the first and
+# twice as long before each later one, so rate limits get time to clear
+FETCH_RETRIES = 3
+RETRY_BACKOFF = 1.0
+# Headers fetched in the cheap first pass, enough to exclude emails before downloading bodies
+METADATA_HEADERS = ["Subject", "From", "Date"]
+# The only headers read from a message; full messages carry dozens of others
+_USED_HEADERS = frozenset(METADATA_HEADERS)
+# Full messages fetched by either script, keyed by message ID. Gmail message content
+# never changes, so entries stay valid; delete the file to force a re-download.
+CACHE_FILE = "gmail_cache.db"
+
 # Passenger name variants to filter bookings (case-insensitive)
 PASSENGER_NAMES = ["mohammad sohail ahmad", "sohail ahmad"]
 
@@ -142,7 +170,7 @@ AIRLINE_CODES = {
 }
 
 # Common 3-letter English words to exclude from airport code detection
-AIRPORT_STOPWORDS = {
+AIRPORT_STOPWORDS = frozenset({
     "THE", "AND", "FOR", "YOU", "ARE", "HAS", "WAS", "HIS", "HER", "OUR",
     "NOT", "BUT", "ALL", "CAN", "HAD", "ONE", "OUT", "DAY", "GET", "HIM",
     "HOW", "ITS", "MAY", "NEW", "NOW", "OLD", "SEE", "WAY", "WHO", "DID",
@@ -150,29 +178,173 @@ AIRPORT_STOPWORDS = {
     "END", "OFF", "RUN", "SET", "TRY", "PUT", "BIG", "FEW", "FAR", "OWN",
     "SAT", "SIT", "TOP", "RED", "HOT", "CUT", "AGO", "YES", "YET", "RAN",
     "BED", "BOX", "BOY", "CAR", "DOG", "EAR", "EAT", "EYE", "FLY", "GAS",
-    "GUN", "HIT", "JOB", "KEY", "LAY", "LEG", "LET", "LIE", "MAP", "MRS",
-    "OIL", "PAY", "PER", "RUN", "SIX", "SUN", "TEN", "WAR", "WET", "WIN",
-    "WON", "YES", "AIR", "ACT", "AGE", "AID", "AIM", "ART", "ASK", "BAD",
-    "BAR", "BIT", "BUY", "COP", "CRY", "DIE", "DIG", "DRY", "DUE", "ERA",
-    "FAN", "FAT", "FEE", "FIT", "FUN", "GAP", "HAT", "HIT", "ICE", "ILL",
-    "JAM", "JET", "LAW", "LAP", "LOG", "LOT", "LOW", "MAN", "MEN", "MET",
-    "MIX", "MOB", "MUD", "NET", "NOR", "NUT", "ODD", "PAN", "PEN", "PET",
-    "PIN", "PIT", "POT", "RAW", "RIB", "RID", "ROB", "ROD", "ROW", "RUB",
-    "SAD", "SIP", "SKI", "TAP", "TAX", "TIE", "TIN", "TIP", "TOE", "TON",
-    "TOW", "TOY", "TUB", "VAN", "VIA", "VOW", "WEB", "WIG", "WIT", "WOE",
-    "YEN", "ZOO", "FWD", "REF", "INR", "USD", "EUR", "SMS", "OTP", "URL",
-    "PDF", "APP", "API", "RSS", "FAQ", "TBA", "TBD", "ETA", "ETD", "GMT",
-    "IST", "EST", "PST", "CST", "UTC", "BAG", "DEP", "ARR", "VIA", "FLT",
-    "ONS", "UAE", "USA", "DGR", "VRM", "STD", "STA", "AVL", "CNF", "RAC",
-    "GEN", "TAT", "OBC", "INF", "ADT", "CHD", "PAX", "SEQ", "ROW", "QTY",
-    "AMT", "TAX", "SUB", "TTL", "NET", "MAX", "MIN", "AVG", "REQ", "RES",
-    "MOB", "TEL", "WEB", "ORG", "GOV", "EDU", "MIL", "INT", "EXT", "SRC",
-    "DST", "MSG", "ERR", "LOG", "CMD", "SYS", "BUS", "CAB", "EMI", "EMD",
+    "GUN", "HIT", "JOB", "KEY", "LAY", "LEG", "LIE", "MAP", "MRS", "OIL",
+    "PAY", "PER", "SIX", "SUN", "TEN", "WAR", "WET", "WIN", "WON", "AIR",
+    "ACT", "AGE", "AID", "AIM", "ART", "ASK", "BAD", "BAR", "BIT", "BUY",
+    "COP", "CRY", "DIE", "DIG", "DRY", "DUE", "ERA", "FAN", "FAT", "FEE",
+    "FIT", "FUN", "GAP", "HAT", "ICE", "ILL", "JAM", "JET", "LAW", "LAP",
+    "LOG", "LOT", "LOW", "MAN", "MEN", "MET", "MIX", "MOB", "MUD", "NET",
+    "NOR", "NUT", "ODD", "PAN", "PEN", "PET", "PIN", "PIT", "POT", "RAW",
+    "RIB", "RID", "ROB", "ROD", "ROW", "RUB", "SAD", "SIP", "SKI", "TAP",
+    "TAX", "TIE", "TIN", "TIP", "TOE", "TON", "TOW", "TOY", "TUB", "VAN",
+    "VIA", "VOW", "WEB", "WIG", "WIT", "WOE", "YEN", "ZOO", "FWD", "REF",
+    "INR", "USD", "EUR", "SMS", "OTP", "URL", "PDF", "APP", "API", "RSS",
+    "FAQ", "TBA", "TBD", "ETA", "ETD", "GMT", "IST", "EST", "PST", "CST",
+    "UTC", "BAG", "DEP", "ARR", "FLT", "ONS", "UAE", "USA", "DGR", "VRM",
+    "STD", "STA", "AVL", "CNF", "RAC", "GEN", "TAT", "OBC", "INF", "ADT",
+    "CHD", "PAX", "SEQ", "QTY", "AMT", "SUB", "TTL", "MAX", "MIN", "AVG",
+    "REQ", "RES", "TEL", "ORG", "GOV", "EDU", "MIL", "INT", "EXT", "SRC",
+    "DST", "MSG", "ERR", "CMD", "SYS", "BUS", "CAB", "EMI", "EMD",
+})
+
+# 2-letter codes that look like airline codes but are not (common false positives)
+FLIGHT_NUM_STOPWORDS = frozenset({
+    "NA", "NO", "IN", "TO", "AT", "ON", "OR", "IS", "IF", "UP",
+    "AN", "AS", "BY", "DO", "GO", "HE", "IT", "ME", "MY", "OF",
+    "SO", "US", "WE", "AM", "PM", "RS", "MR", "MS", "DR", "ID",
+})
+
+# Common words/substrings that get falsely captured as PNR codes
+PNR_STOPWORDS = frozenset({
+    "NUMBER", "REFERENCE", "BOOKING", "CONFIRM", "DETAIL", "DETAILS",
+    "FLIGHT", "STATUS", "CANCEL", "CHANGE", "UPDATE", "ERENCE",
+    "RENCE", "UMBER", "ATION", "TICKET", "TRAVEL",
+    "PLEASE", "REFUND", "AMOUNT", "TOTAL", "PRICE", "CHARGE",
+    "EMAIL", "ISSUE", "BOARD", "CHECK", "PRINT", "VALID",
+    "NUMERIC", "STRING", "FORMAT", "RETURN",
+})
+
+# Subject keywords marking non-flight emails (matched case-insensitively)
+EXCLUDE_SUBJECTS = [
+    "hotel booking", "bus booking", "bus ticket", "credit card",
+    "account summary", "savings of rs", "missed out on saving",
+    "message from our ceo", "message from the ceo",
+    "discounts in dubai", "big discounts", "credit note",
+    "tax invoice", "gst invoice", "vrl travels",
+    "credit card communication", "voucher worth",
+    "challenge #", "intermiles credited",
+    "booking has been changed", "your booking has been",
+    "booking cancelled", "booking canceled",
+    "confirmation voucher", "beach hotel",
+    "reference no.", "gst invoice", "tax invoice",
+    "cabin baggage reminder",
+]
+
+# International airlines to exclude (user only flies domestic)
+EXCLUDE_AIRLINES = {
+    "Emirates", "United Airlines", "Etihad", "Qatar Airways",
+    "Singapore Airlines", "Lufthansa", "British Airways", "KLM",
+    "Air France", "Delta Airlines", "American Airlines",
+    "Southwest Airlines", "Thai Airways", "Cathay Pacific",
+    "FlyDubai", "Oman Air", "Saudia", "Turkish Airlines",
 }
 
+# Regexes are compiled once at import time; the extractors run them over every email body
+# Only valid flight numbers match: the code is a known airline code or two letters, and not
+# a stopword. The leading lookahead cheaply rejects positions that cannot be a flight number.
+_FLIGHT_NUM_RE = re.compile(
+    r"\b(?=[A-Z0-9]{2}\s?\d)(?!%s)(%s|[A-Z]{2})\s?(\d{1,4})\b"
+    % ("|".join(sorted(FLIGHT_NUM_STOPWORDS)), "|".join(sorted(c for c in AIRLINE_CODES if not c.isalpha())))
+)
+_FLIGHT_NUM_CTX_RE = re.compile(r"(?:flight|flt|flt\.)\s*(?:no\.?\s*)?([A-Z0-9]{2}\s?\d{1,4})", re.IGNORECASE)
+
+# Airport codes are read from the first 3-letter word (any case, validated later)
+# following a from/to keyword by at most 30 characters after an optional colon
+_WORD3_RE = re.compile(r"\b[A-Za-z]{3}\b")
+_FROM_KW_RE = re.compile(r"from|departure|depart|origin", re.IGNORECASE)
+_TO_KW_RE = re.compile(r"to|arrival|arrive|destination", re.IGNORECASE)
+_AIRPORT_KW_GAP = 30
+# "XXX → YYY" or "XXX - YYY" route patterns (strict uppercase only)
+_ROUTE_RE = re.compile(r"\b([A-Z]{3})\s*(?:→|->|–|—|-)\s*([A-Z]{3})\b")
+
+# All supported date shapes fused into one alternation so the body is scanned once;
+# each named alternative is followed by its three component groups
+_DATE_RE = re.compile(
+    # 15 Jan 2025, 15-Jan-2025
+    r"(?P<dmy>\b(\d{1,2})\s*(?:[-/]\s*)?(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s*(?:[-/,]\s*)?(\d{4})\b)"
+    # Jan 15, 2025
+    r"|(?P<mdy>\b(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+(\d{1,2})\s*(?:,\s*)?(\d{4})\b)"
+    # 2025-01-15
+    r"|(?P<iso>\b(\d{4})-(\d{2})-(\d{2})\b)"
+    # 15/01/2025 or 15-01-2025
+    r"|(?P<num>\b(\d{2})[/-](\d{2})[/-](\d{4})\b)",
+    re.IGNORECASE,
+)
+# Month numbers by the 3-letter prefix the dmy/mdy alternatives capture
+_MONTHS = {
+    name: number
+    for number, name in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), 1
+    )
+}
+# A date is "in flight context" when one of these keywords precedes it on the same
+# line, with the date ending at most _DATE_CTX_REACH characters after the keyword
+_DATE_CTX_RE = re.compile(r"date|departure|depart|travel|journey|flight", re.IGNORECASE)
+_DATE_CTX_REACH = 80
+
+# Optional separators are written as "(?:sep\s*)?" rather than "\s*sep?\s*": adjacent
+# \s* runs make a failed match backtrack polynomially over long runs of whitespace
+_PNR_RES = [
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        # Standard PNR patterns (exactly 5-6 chars)
+        r"(?:PNR|pnr|Pnr)\s*(?:(?:no\.?|number|#|:)\s*)?(?::\s*)?\b([A-Z0-9]{5,6})\b",
+        r"(?:booking\s*(?:ref|reference|code|no)|confirmation\s*(?:no|number|code|#))\s*(?::\s*)?\b([A-Z0-9]{5,6})\b",
+        r"(?:reference|ref\.?)\s*(?:(?:no\.?|number|#|:)\s*)?(?::\s*)?\b([A-Z0-9]{6})\b",
+        # IndiGo itinerary PNR from subject: "Itinerary - XXXXXX"
+        r"[Ii]tinerary\s*[-–—]\s*\b([A-Z0-9]{6})\b",
+    )
+]
+
+# Any passenger name variant, matched against casefolded text in one scan
+_NAME_RE = re.compile("|".join(re.escape(name.casefold()) for name in PASSENGER_NAMES))
+
+_DOMAIN_RE = re.compile(r"@([\w.-]+)")
+# Plain str results; the default "smart strings" keep a parent reference per text node
+_TEXT_NODES = etree.XPath("descendant::text()", smart_strings=False)
+
+
+def _build_airline_automaton():
+    """Aho-Corasick automaton over airline keys and names, valued (priority, airline).
+
+    Priority is the KNOWN_AIRLINES position of the first entry a word would match,
+    so the lowest-priority hit reproduces the dict-order lookup in one pass.
+    """
+    words = {}
+    for priority, (key, airline) in enumerate(KNOWN_AIRLINES.items()):
+        for word in (key, airline.lower()):
+            words.setdefault(word, (priority, airline))
+    automaton = ahocorasick.Automaton()
+    for word, value in words.items():
+        automaton.add_word(word, value)
+    automaton.make_automaton()
+    return automaton
+
+
+def _build_keyword_automaton(keywords):
+    """Aho-Corasick automaton that matches any of the given lowercase keywords."""
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        automaton.add_word(keyword, keyword)
+    automaton.make_automaton()
+    return automaton
+
+
+_AIRLINE_AC = _build_airline_automaton()
+_EXCLUDE_AC = _build_keyword_automaton(EXCLUDE_SUBJECTS)
+
 
 def authenticate():
-    """Authenticate with Gmail API via OAuth2."""
+    """Authenticate with Gmail API via OAuth2, returning the credentials.
+
+    Only called once, from the main thread: it may refresh and rewrite token.json or
+    run the consent flow. Clients are then built from the credentials (see thread_service).
+    """
+    # The Google client libraries are imported here rather than at module level: they
+    # take ~0.4 s to import, which tools using only the extractors should not pay
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+
     creds = None
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
@@ -186,110 +358,231 @@ def authenticate():
                 print("Download your OAuth client secret from Google Cloud Console")
                 print("and place it in this directory as credentials.json")
                 raise SystemExit(1)
+            # Only needed for the first-run consent flow
+            from google_auth_oauthlib.flow import InstalledAppFlow
+
             flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
             creds = flow.run_local_server(port=0)
         with open("token.json", "w") as token:
             token.write(creds.to_json())
 
+    return creds
+
+
+def build_service(creds):
+    """Build a Gmail API client from already obtained credentials."""
+    from googleapiclient.discovery import build
+
     return build("gmail", "v1", credentials=creds)
 
 
-def search_flights(service):
-    """Search Gmail for flight-related emails across multiple queries."""
-    message_ids = set()
-    messages = []
+_thread_local = threading.local()
+
+
+def thread_service(creds):
+    """Return a Gmail service owned by the calling thread (httplib2 is not thread-safe).
+
+    The service is built from the given credentials only, so worker threads never
+    read or rewrite token.json.
+    """
+    if not hasattr(_thread_local, "service"):
+        _thread_local.service = build_service(creds)
+    return _thread_local.service
 
-    for query in SEARCH_QUERIES:
-        page_token = None
-        while True:
-            result = (
-                service.users()
-                .messages()
-                .list(userId="me", q=f"{query} has:attachment", pageToken=page_token, includeSpamTrash=True)
-                .execute()
-            )
-            batch = result.get("messages", [])
-            for msg in batch:
-                if msg["id"] not in message_ids:
-                    message_ids.add(msg["id"])
-                    messages.append(msg)
-            page_token = result.get("nextPageToken")
-            if not page_token:
-                break
-        print(f"  Query {query}: found messages (total unique so far: {len(message_ids)})")
 
-    print(f"\nTotal unique flight emails found: {len(messages)}")
+def _search_query(service, query):
+    """Return all message stubs matching one Gmail query, following pagination."""
+    messages = []
+    page_token = None
+    while True:
+        result = (
+            service.users()
+            .messages()
+            .list(
+                userId="me",
+                q=f"{query} has:attachment",
+                pageToken=page_token,
+                includeSpamTrash=True,
+                maxResults=LIST_PAGE_SIZE,
+            )
+            .execute()
+        )
+        messages.extend(result.get("messages", []))
+        page_token = result.get("nextPageToken")
+        if not page_token:
+            break
     return messages
 
 
+def search_flights(service):
+    """Search Gmail for flight-related emails with a single query covering every search term.
+
+    Returns the unique matching message IDs in Gmail's listing order.
+    """
+    # Gmail's OR binds tighter than the implicit AND, so the trailing has:attachment applies to every term
+    query = " OR ".join(f"({q})" for q in SEARCH_QUERIES)
+    # Pages of one listing should not overlap, but never hand the same id downstream twice;
+    # dict.fromkeys dedups in one pass and, unlike a set, keeps the listing order
+    msg_ids = list(dict.fromkeys(msg["id"] for msg in _search_query(service, query)))
+
+    print(f"\nTotal unique flight emails found: {len(msg_ids)}")
+    return msg_ids
+
+
+def _get_message(creds, msg_id, params):
+    """Fetch a single message using the calling thread's service."""
+    return thread_service(creds).users().messages().get(userId="me", id=msg_id, **params).execute()
+
+
+# One pool for every fallback fetch: its threads, and the service each has built, are
+# reused across fetch_messages calls instead of being recreated per call
+_fallback_pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+async def _gather_messages(creds, msg_ids, params):
+    """Fetch messages concurrently on the fallback pool (used when batching fails)."""
+    loop = asyncio.get_running_loop()
+    tasks = [loop.run_in_executor(_fallback_pool, _get_message, creds, mid, params) for mid in msg_ids]
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _is_retryable(exception):
+    """Whether a failed fetch may succeed later (anything but a permanent HTTP error)."""
+    return not isinstance(exception, HttpError) or exception.resp.status in RETRYABLE_STATUSES
+
+
+def fetch_messages(creds, msg_ids, cache=None, **params):
+    """Fetch messages in batches of BATCH_SIZE, returning a dict keyed by message ID.
+
+    Requests go through the calling thread's service, built from creds. Extra keyword
+    arguments are passed to messages.get (e.g. format="metadata"). With a cache (a shelf
+    keyed by message ID), hits are served from it, only misses are requested, and newly
+    fetched messages are stored back.
+    """
+    service = thread_service(creds)
+    fetched = {}
+    failed = []
+
+    if cache is not None:
+        for mid in msg_ids:
+            msg = cache.get(mid)
+            if msg is not None:
+                fetched[mid] = msg
+    missing = [mid for mid in msg_ids if mid not in fetched]
+
+    def _on_response(request_id, response, exception):
+        if exception is None:
+            fetched[request_id] = response
+        elif not _is_retryable(exception):
+            # Permanent per-message errors (e.g. 404 for a deleted email) are not retried
+            print(f"   Warning: Failed to fetch message {request_id}: {exception}")
+        else:
+            failed.append(request_id)
+
+    ids = iter(missing)
+    while True:
+        chunk = list(islice(ids, BATCH_SIZE))
+        if not chunk:
+            break
+        batch = service.new_batch_http_request(callback=_on_response)
+        for mid in chunk:
+            batch.add(service.users().messages().get(userId="me", id=mid, **params), request_id=mid)
+        try:
+            batch.execute()
+        except Exception as e:
+            print(f"   Warning: Batch request failed, fetching individually: {e}")
+            failed.extend(mid for mid in chunk if mid not in fetched and mid not in failed)
+        print(f"   Fetched {len(fetched)}/{len(msg_ids)} emails...")
+
+    # Retry anything the batch endpoint could not deliver with one request per message,
+    # backing off exponentially so a rate limit is not hit again straight away
+    for attempt in range(FETCH_RETRIES):
+        if not failed:
+            break
+        time.sleep(RETRY_BACKOFF * 2**attempt)
+        responses = asyncio.run(_gather_messages(creds, failed, params))
+        retry = []
+        for mid, response in zip(failed, responses):
+            if not isinstance(response, Exception):
+                fetched[mid] = response
+            elif _is_retryable(response) and attempt + 1 < FETCH_RETRIES:
+                retry.append(mid)
+            else:
+                print(f"   Warning: Failed to fetch message {mid}: {response}")
+        failed = retry
+
+    if cache is not None:
+        for mid in missing:
+            if mid in fetched:
+                cache[mid] = fetched[mid]
+
+    return fetched
+
+
 def get_message_body(payload):
     """Extract plain text or HTML body from a Gmail message payload."""
-    plain_text = ""
-    html_text = ""
-
-    if payload.get("mimeType") == "text/plain":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            plain_text = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif payload.get("mimeType") == "text/html":
-        data = payload.get("body", {}).get("data", "")
-        if data:
-            html_text = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif "parts" in payload:
-        for part in payload["parts"]:
-            p, h = _extract_parts(part)
-            if p:
-                plain_text += p
-            if h:
-                html_text += h
-
-    if plain_text:
-        return plain_text
-    if html_text:
-        soup = BeautifulSoup(html_text, "html.parser")
-        return soup.get_text(separator=" ", strip=True)
+    plain_parts, html_parts = _extract_parts(payload)
+
+    # Only the chosen alternative is decoded: the HTML parts are dropped whenever text/plain exists
+    if plain_parts:
+        return "".join(map(_decode_part, plain_parts))
+    if html_parts:
+        return _html_to_text("".join(map(_decode_part, html_parts)))
     return ""
 
 
-def _extract_parts(part):
-    """Recursively extract text from message parts."""
-    plain = ""
-    html = ""
-    mime = part.get("mimeType", "")
-
-    if mime == "text/plain":
-        data = part.get("body", {}).get("data", "")
-        if data:
-            plain = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif mime == "text/html":
-        data = part.get("body", {}).get("data", "")
-        if data:
-            html = base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
-    elif "parts" in part:
-        for sub in part["parts"]:
-            p, h = _extract_parts(sub)
-            plain += p
-            html += h
+def _decode_part(data):
+    return pybase64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
+
+
+def _html_to_text(html_text):
+    """Visible text of an HTML body: stripped text nodes joined by single spaces."""
+    try:
+        doc = etree.HTML(html_text)
+    except ValueError:
+        # str input may not carry an <?xml encoding=...?> declaration; the text is already UTF-8 clean
+        doc = etree.HTML(html_text.encode("utf-8"), etree.HTMLParser(encoding="utf-8"))
+    body = doc.find("body") if doc is not None else None
+    if body is None:
+        return ""
+    # Script/style contents are not visible text; keep their tails as separate nodes
+    for el in body.iter("script", "style", "template"):
+        el.clear(keep_tail=True)
+    return " ".join(filter(None, (t.strip() for t in _TEXT_NODES(body))))
+
+
+def _extract_parts(payload):
+    """Collect the still-encoded text/plain and text/html bodies of a MIME tree, in document order."""
+    plain = []
+    html = []
+    # Walk with an explicit stack: no recursion limit on deeply nested multiparts
+    stack = [payload]
+
+    while stack:
+        part = stack.pop()
+        mime = part.get("mimeType", "")
+        if mime == "text/plain":
+            data = part.get("body", {}).get("data", "")
+            if data:
+                plain.append(data)
+        elif mime == "text/html":
+            data = part.get("body", {}).get("data", "")
+            if data:
+                html.append(data)
+        elif "parts" in part:
+            # Reversed so sibling parts are popped in their original order
+            stack.extend(reversed(part["parts"]))
 
     return plain, html
 
 
 def extract_flight_number(text):
     """Extract flight number in IATA format (e.g., AI302, 6E2341)."""
-    # 2-letter codes that look like airline codes but are not (common false positives)
-    FLIGHT_NUM_STOPWORDS = {"NA", "NO", "IN", "TO", "AT", "ON", "OR", "IS", "IF", "UP",
-                            "AN", "AS", "BY", "DO", "GO", "HE", "IT", "ME", "MY", "OF",
-                            "SO", "US", "WE", "AM", "PM", "RS", "MR", "MS", "DR", "ID"}
-    pattern = r"\b([A-Z0-9]{2})\s?(\d{1,4})\b"
-    matches = re.findall(pattern, text)
-    for code, num in matches:
-        if code in FLIGHT_NUM_STOPWORDS:
-            continue
-        if code in AIRLINE_CODES or (code[0].isalpha() and code[1].isalpha()):
-            return f"{code}{num}"
+    match = _FLIGHT_NUM_RE.search(text)
+    if match:
+        return f"{match.group(1)}{match.group(2)}"
     # Fallback: look for common patterns with airline context
-    pattern2 = r"(?:flight|flt|flt\.)\s*(?:no\.?\s*)?([A-Z0-9]{2}\s?\d{1,4})"
-    match = re.search(pattern2, text, re.IGNORECASE)
+    match = _FLIGHT_NUM_CTX_RE.search(text)
     if match:
         return match.group(1).replace(" ", "")
     return ""
@@ -297,191 +590,198 @@ def extract_flight_number(text):
 
 def extract_airport_codes(text):
     """Extract origin and destination airport codes."""
-    from_code = ""
-    to_code = ""
-
-    # Pattern: keyword followed by a 3-letter uppercase airport code (not IGNORECASE for the code)
-    from_patterns = [
-        r"(?i)(?:from|departure|depart|origin)\s*:?\s*.{0,30}?\b([A-Z]{3})\b",
-    ]
-    to_patterns = [
-        r"(?i)(?:to|arrival|arrive|destination)\s*:?\s*.{0,30}?\b([A-Z]{3})\b",
-    ]
-
-    def _valid_airport(code):
-        return code.isupper() and code not in AIRPORT_STOPWORDS
-
-    for pattern in from_patterns:
-        for match in re.finditer(pattern, text):
-            candidate = match.group(1)
-            if _valid_airport(candidate):
-                from_code = candidate
+    # Tokenize once; each keyword then bisects to the word right after it
+    words = [(m.start(), m.group()) for m in _WORD3_RE.finditer(text)]
+    starts = [start for start, _ in words]
+
+    def _code_after(keyword_re):
+        # Like a regex scan, resume after the last examined word: a keyword inside a
+        # rejected candidate (the "to" of "TOP") is not retried
+        resume = 0
+        for kw in keyword_re.finditer(text):
+            if kw.start() < resume:
+                continue
+            i = bisect_left(starts, kw.end())
+            if i == len(words):
                 break
+            start, candidate = words[i]
+            gap = text[kw.end():start].lstrip()
+            if gap.startswith(":"):
+                gap = gap[1:].lstrip()
+            if len(gap) > _AIRPORT_KW_GAP or "\n" in gap:
+                continue
+            if candidate.isupper() and candidate not in AIRPORT_STOPWORDS:
+                return candidate
+            resume = start + 3
+        return ""
 
-    for pattern in to_patterns:
-        for match in re.finditer(pattern, text):
-            candidate = match.group(1)
-            if _valid_airport(candidate):
-                to_code = candidate
-                break
+    from_code = _code_after(_FROM_KW_RE)
+    to_code = _code_after(_TO_KW_RE)
 
-    # Fallback: look for "XXX → YYY" or "XXX - YYY" route patterns (strict uppercase only)
+    # Fallback: look for route patterns
     if not from_code or not to_code:
-        route_pattern = r"\b([A-Z]{3})\s*(?:→|->|–|—|-)\s*([A-Z]{3})\b"
-        route_match = re.search(route_pattern, text)
+        route_match = _ROUTE_RE.search(text)
         if route_match:
             c1, c2 = route_match.group(1), route_match.group(2)
-            if not from_code and _valid_airport(c1):
+            if not from_code and c1 not in AIRPORT_STOPWORDS:
                 from_code = c1
-            if not to_code and _valid_airport(c2):
+            if not to_code and c2 not in AIRPORT_STOPWORDS:
                 to_code = c2
 
     return from_code, to_code
 
 
+def _parse_date_match(match):
+    """Convert a _DATE_RE match to YYYY-MM-DD, or "" if invalid or out of range."""
+    kind = match.lastgroup
+    first, second, third = match.group(match.lastindex + 1, match.lastindex + 2, match.lastindex + 3)
+    # The regex already fixes each field's shape, so the fields are read directly
+    # instead of being re-parsed by strptime
+    if kind == "dmy":
+        year, month, day = int(third), _MONTHS.get(second[:3].lower()), int(first)
+    elif kind == "mdy":
+        year, month, day = int(third), _MONTHS.get(first[:3].lower()), int(second)
+    elif kind == "iso":
+        year, month, day = int(first), int(second), int(third)
+    else:
+        year, month, day = int(third), int(second), int(first)
+    # Reject dates outside reasonable range
+    if month is None or not 1990 <= year <= 2030:
+        return ""
+    try:
+        # Only for validation: rejects impossible dates such as 31 Feb or month 13
+        datetime(year, month, day)
+    except ValueError:
+        return ""
+    return f"{year}-{month:02d}-{day:02d}"
+
+
+def _in_date_context(text, start, end):
+    """Check whether a flight keyword shortly precedes text[start:end] on the same line."""
+    # Only a bounded window before the date is examined, never the whole body
+    window_start = max(0, end - _DATE_CTX_REACH - len("departure"))
+    newline = text.rfind("\n", window_start, start)
+    if newline != -1:
+        window_start = newline + 1
+    for kw in _DATE_CTX_RE.finditer(text, window_start, start):
+        if end - kw.end() <= _DATE_CTX_REACH:
+            return True
+    return False
+
+
 def extract_flight_date(text):
     """Extract flight date from email body."""
-    date_patterns = [
-        # 15 Jan 2025, 15-Jan-2025
-        (r"\b(\d{1,2})\s*[-/]?\s*(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s*[-/,]?\s*(\d{4})\b", "%d %b %Y"),
-        # Jan 15, 2025
-        (r"\b(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+(\d{1,2})\s*[,]?\s*(\d{4})\b", "%b %d %Y"),
-        # 2025-01-15
-        (r"\b(\d{4})-(\d{2})-(\d{2})\b", "%Y-%m-%d"),
-        # 15/01/2025 or 15-01-2025
-        (r"\b(\d{2})[/-](\d{2})[/-](\d{4})\b", "%d/%m/%Y"),
-    ]
+    # Single pass: the first valid date near a flight keyword wins, else the first valid date
+    first = ""
+    for match in _DATE_RE.finditer(text):
+        parsed = _parse_date_match(match)
+        if not parsed:
+            continue
+        if _in_date_context(text, match.start(), match.end()):
+            return parsed
+        if not first:
+            first = parsed
+    return first
 
-    # Search near flight-related keywords first
-    flight_context = re.findall(
-        r"(?:date|departure|depart|travel|journey|flight).{0,80}",
-        text,
-        re.IGNORECASE,
-    )
-    search_texts = flight_context + [text]
-
-    for search_text in search_texts:
-        for pattern, fmt in date_patterns:
-            match = re.search(pattern, search_text, re.IGNORECASE)
-            if match:
-                try:
-                    groups = match.groups()
-                    if fmt == "%d %b %Y":
-                        date_str = f"{groups[0]} {groups[1][:3]} {groups[2]}"
-                        parsed = datetime.strptime(date_str, fmt)
-                    elif fmt == "%b %d %Y":
-                        date_str = f"{groups[0][:3]} {groups[1]} {groups[2]}"
-                        parsed = datetime.strptime(date_str, fmt)
-                    elif fmt == "%Y-%m-%d":
-                        date_str = f"{groups[0]}-{groups[1]}-{groups[2]}"
-                        parsed = datetime.strptime(date_str, fmt)
-                    elif fmt == "%d/%m/%Y":
-                        date_str = f"{groups[0]}/{groups[1]}/{groups[2]}"
-                        parsed = datetime.strptime(date_str, fmt)
-                    else:
-                        continue
-                    # Reject dates outside reasonable range
-                    if 1990 <= parsed.year <= 2030:
-                        return parsed.strftime("%Y-%m-%d")
-                except ValueError:
-                    continue
 
+def _airline_from_sender(sender):
+    """Match the sender's email domain against KNOWN_AIRLINES keys."""
+    domain_match = _DOMAIN_RE.search(sender)
+    if domain_match:
+        return _airline_from_domain(domain_match.group(1))
     return ""
 
 
-def extract_airline(text, sender):
-    """Extract airline name from sender or email body."""
+# A mailbox holds few distinct sender domains, so each is matched against the keys only once
+@lru_cache(maxsize=None)
+def _airline_from_domain(domain):
+    domain = domain.lower().replace(".", "")
+    for key, airline in KNOWN_AIRLINES.items():
+        if key in domain:
+            return airline
+    return ""
+
+
+def extract_airline(text, sender, flight_number=None, text_lower=None):
+    """Extract airline name from sender or email body.
+
+    Pass flight_number and text_lower (text.casefold()) if the caller already has them,
+    to skip recomputing them here.
+    """
     # Check sender domain
-    domain_match = re.search(r"@([\w.-]+)", sender)
-    if domain_match:
-        domain = domain_match.group(1).lower().replace(".", "")
-        for key, airline in KNOWN_AIRLINES.items():
-            if key in domain:
-                return airline
+    airline = _airline_from_sender(sender)
+    if airline:
+        return airline
 
     # Check flight number for airline code
-    flight_num = extract_flight_number(text)
-    if flight_num and len(flight_num) >= 2:
-        code = flight_num[:2]
+    if flight_number is None:
+        flight_number = extract_flight_number(text)
+    if flight_number and len(flight_number) >= 2:
+        code = flight_number[:2]
         if code in AIRLINE_CODES:
             return AIRLINE_CODES[code]
 
-    # Check body for airline names
-    text_lower = text.lower()
-    for key, airline in KNOWN_AIRLINES.items():
-        if key in text_lower or airline.lower() in text_lower:
-            return airline
+    # Check body for airline names (single scan for every key and name at once)
+    best = None
+    if text_lower is None:
+        text_lower = text.casefold()
+    for _, hit in _AIRLINE_AC.iter(text_lower):
+        if best is None or hit < best:
+            best = hit
+            if best[0] == 0:
+                break
+    if best:
+        return best[1]
 
     return ""
 
 
+def _is_excluded(subject):
+    """Check whether a subject line contains any EXCLUDE_SUBJECTS keyword."""
+    return next(_EXCLUDE_AC.iter(subject.lower()), None) is not None
+
+
 def extract_pnr(text):
     """Extract PNR or booking reference (standard 6-char alphanumeric format)."""
-    patterns = [
-        # Standard PNR patterns (exactly 5-6 chars)
-        r"(?:PNR|pnr|Pnr)\s*(?:no\.?|number|#|:)?\s*:?\s*\b([A-Z0-9]{5,6})\b",
-        r"(?:booking\s*(?:ref|reference|code|no)|confirmation\s*(?:no|number|code|#))\s*:?\s*\b([A-Z0-9]{5,6})\b",
-        r"(?:reference|ref\.?)\s*(?:no\.?|number|#|:)?\s*:?\s*\b([A-Z0-9]{6})\b",
-        # IndiGo itinerary PNR from subject: "Itinerary - XXXXXX"
-        r"[Ii]tinerary\s*[-–—]\s*\b([A-Z0-9]{6})\b",
-    ]
-    # Common words/substrings that get falsely captured as PNR codes
-    pnr_stopwords = {
-        "NUMBER", "REFERENCE", "BOOKING", "CONFIRM", "DETAIL", "DETAILS",
-        "FLIGHT", "STATUS", "CANCEL", "CHANGE", "UPDATE", "ERENCE",
-        "RENCE", "UMBER", "ATION", "UMBER", "TICKET", "TRAVEL",
-        "PLEASE", "REFUND", "AMOUNT", "TOTAL", "PRICE", "CHARGE",
-        "EMAIL", "ISSUE", "BOARD", "CHECK", "PRINT", "VALID",
-        "NUMERIC", "STRING", "FORMAT", "RETURN",
-    }
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for pattern in _PNR_RES:
+        match = pattern.search(text)
         if match:
             candidate = match.group(1).upper()
-            if candidate not in pnr_stopwords:
+            if candidate not in PNR_STOPWORDS:
                 return candidate
     return ""
 
 
-def parse_email(service, msg_id):
-    """Fetch and parse a single email for flight details."""
-    msg = service.users().messages().get(userId="me", id=msg_id, format="full").execute()
+def parse_email(msg):
+    """Parse a fetched Gmail message for flight details."""
     payload = msg.get("payload", {})
-    headers = {h["name"]: h["value"] for h in payload.get("headers", [])}
+    headers = {h["name"]: h["value"] for h in payload.get("headers", []) if h["name"] in _USED_HEADERS}
 
     subject = headers.get("Subject", "")
     sender = headers.get("From", "")
     email_date_raw = headers.get("Date", "")
 
-    # Parse email received date
+    # Parse email received date; RFC 2822 parsing also covers named zones, "(UTC)" comments and 2-digit years
     email_date = ""
     if email_date_raw:
-        # Clean timezone info for parsing
-        clean_date = re.sub(r"\s*\(.*\)", "", email_date_raw)
-        for fmt in (
-            "%a, %d %b %Y %H:%M:%S %z",
-            "%d %b %Y %H:%M:%S %z",
-            "%a, %d %b %Y %H:%M:%S",
-            "%d %b %Y %H:%M:%S",
-        ):
-            try:
-                email_date = datetime.strptime(clean_date.strip(), fmt).strftime("%Y-%m-%d")
-                break
-            except ValueError:
-                continue
+        try:
+            email_date = parsedate_to_datetime(email_date_raw).strftime("%Y-%m-%d")
+        except (TypeError, ValueError):
+            pass
 
     body = get_message_body(payload)
     full_text = f"{subject} {body}"
+    # Casefolded once and shared by every case-insensitive check below
+    text_lower = full_text.casefold()
 
     flight_number = extract_flight_number(full_text)
     from_code, to_code = extract_airport_codes(full_text)
     flight_date = extract_flight_date(full_text)
-    airline = extract_airline(full_text, sender)
+    airline = extract_airline(full_text, sender, flight_number, text_lower)
     pnr = extract_pnr(full_text)
 
     # Check if passenger name appears in the email
-    text_lower = full_text.lower()
-    has_passenger_name = any(name in text_lower for name in PASSENGER_NAMES)
+    has_passenger_name = _NAME_RE.search(text_lower) is not None
 
     return {
         "Date": flight_date or email_date,
@@ -501,115 +801,138 @@ def main():
     print("=" * 40)
 
     print("\n1. Authenticating with Gmail...")
-    service = authenticate()
+    creds = authenticate()
     print("   Authenticated successfully.")
 
     print("\n2. Searching for flight emails...")
-    messages = search_flights(service)
+    msg_ids = search_flights(thread_service(creds))
 
-    if not messages:
+    if not msg_ids:
         print("\nNo flight-related emails found.")
         return
 
-    print(f"\n3. Parsing {len(messages)} emails for flight details...")
-    flights = []
-    for i, msg in enumerate(messages, 1):
-        if i % 10 == 0 or i == len(messages):
-            print(f"   Processed {i}/{len(messages)} emails...")
-        try:
-            flight = parse_email(service, msg["id"])
-            flights.append(flight)
-        except Exception as e:
-            print(f"   Warning: Failed to parse message {msg['id']}: {e}")
-
-    # Exclude non-flight emails by subject keywords
-    EXCLUDE_SUBJECTS = [
-        "hotel booking", "bus booking", "bus ticket", "credit card",
-        "account summary", "savings of rs", "missed out on saving",
-        "message from our ceo", "message from the ceo",
-        "discounts in dubai", "big discounts", "credit note",
-        "tax invoice", "gst invoice", "vrl travels",
-        "credit card communication", "voucher worth",
-        "challenge #", "intermiles credited",
-        "booking has been changed", "your booking has been",
-        "booking cancelled", "booking canceled",
-        "confirmation voucher", "beach hotel",
-        "reference no.", "gst invoice", "tax invoice",
-        "cabin baggage reminder",
-    ]
-    # International airlines to exclude (user only flies domestic)
-    EXCLUDE_AIRLINES = {"Emirates", "United Airlines", "Etihad", "Qatar Airways",
-                        "Singapore Airlines", "Lufthansa", "British Airways", "KLM",
-                        "Air France", "Delta Airlines", "American Airlines",
-                        "Southwest Airlines", "Thai Airways", "Cathay Pacific",
-                        "FlyDubai", "Oman Air", "Saudia", "Turkish Airlines"}
-    def _is_excluded(subject):
-        s = subject.lower()
-        return any(kw in s for kw in EXCLUDE_SUBJECTS)
-
-    non_excluded = [f for f in flights if not _is_excluded(f["Email Subject"])]
-    print(f"   Excluded {len(flights) - len(non_excluded)} non-flight emails by subject")
-    flights = non_excluded
-
-    # Exclude international airlines (domestic flights only)
-    domestic = [f for f in flights if f["Airline"] not in EXCLUDE_AIRLINES]
-    print(f"   Excluded {len(flights) - len(domestic)} international airline emails")
-    flights = domestic
-
-    # Filter: keep only actual flight bookings (must have flight number, PNR, or route)
-    actual_flights = [
-        f for f in flights
-        if f["Flight Number"] or f["PNR/Booking Ref"] or (f["From"] and f["To"])
-    ]
-    print(f"   Filtered to {len(actual_flights)} actual flight records (removed {len(flights) - len(actual_flights)} non-flight emails)")
-
-    # Filter: keep only bookings with passenger name
-    named_flights = [f for f in actual_flights if f["_has_name"]]
-    print(f"   Filtered to {len(named_flights)} records matching passenger name (removed {len(actual_flights) - len(named_flights)} others)")
-    flights = named_flights
-
-    # Remove internal field before writing CSV
-    for f in flights:
-        del f["_has_name"]
-
-    # Deduplicate by PNR: keep the record with the most extracted data
-    def _richness(f):
-        """Score how much data a record has (more = better)."""
-        return sum([
-            bool(f["Flight Number"]),
-            bool(f["From"]),
-            bool(f["To"]),
-            bool(f["Airline"]),
-            bool(f["Date"]),
-            bool(f["PNR/Booking Ref"]),
-        ])
-
-    seen_pnrs = {}
-    deduped = []
-    for f in flights:
-        pnr = f["PNR/Booking Ref"]
-        if not pnr:
-            # No PNR — keep as-is (deduplicate by flight number + date instead)
-            key = (f["Flight Number"], f["Date"])
+    print(f"\n3. Parsing {len(msg_ids)} emails for flight details...")
+    # Fetch headers only first: emails excluded by subject, or by a sender domain that
+    # identifies an international airline, never have their bodies downloaded. Emails
+    # already in the on-disk cache skip the network entirely.
+    with shelve.open(CACHE_FILE) as cache:
+        uncached_ids = [mid for mid in msg_ids if mid not in cache]
+        metadata = fetch_messages(creds, uncached_ids, format="metadata", metadataHeaders=METADATA_HEADERS)
+        excluded_subject = excluded_airline = unfetched = 0
+        candidate_ids = []
+        for mid in msg_ids:
+            msg = metadata.get(mid) or cache.get(mid)
+            if msg is None:
+                # Already reported by fetch_messages; not an exclusion
+                unfetched += 1
+                continue
+            headers = {
+                h["name"]: h["value"] for h in msg.get("payload", {}).get("headers", []) if h["name"] in _USED_HEADERS
+            }
+            if _is_excluded(headers.get("Subject", "")):
+                excluded_subject += 1
+            elif _airline_from_sender(headers.get("From", "")) in EXCLUDE_AIRLINES:
+                excluded_airline += 1
+            else:
+                candidate_ids.append(mid)
+        print(f"   Skipping {excluded_subject + excluded_airline} emails excluded by their headers")
+        if unfetched:
+            print(f"   Skipping {unfetched} emails whose headers could not be fetched")
+
+        # Bodies are downloaded one batch ahead on a background thread (with its own service
+        # built from the shared creds)
+        # while the current batch is parsed, so network waits overlap CPU-bound parsing
+        def _fetch_chunk(chunk):
+            return fetch_messages(creds, chunk, format="full")
+
+        # The shelf is only touched from this thread: the sqlite dbm backend (the default
+        # from Python 3.13) refuses use from any thread other than the one that opened it
+        def _start_chunk(prefetcher, chunk):
+            hits = {mid: cache[mid] for mid in chunk if mid in cache}
+            misses = [mid for mid in chunk if mid not in hits]
+            return hits, misses, prefetcher.submit(_fetch_chunk, misses) if misses else None
+
+        # Parsed records are yielded one at a time, so those filtered out below are
+        # dropped right away instead of being held until every email is parsed
+        def _parsed_flights():
+            chunks = [candidate_ids[i:i + BATCH_SIZE] for i in range(0, len(candidate_ids), BATCH_SIZE)]
+            processed = 0
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                # Exactly one batch in flight: Executor.map would submit every chunk up front
+                pending = _start_chunk(prefetcher, chunks[0]) if chunks else None
+                for k, chunk in enumerate(chunks):
+                    fetched, misses, future = pending
+                    if future is not None:
+                        downloaded = future.result()
+                        for mid in misses:
+                            if mid in downloaded:
+                                cache[mid] = fetched[mid] = downloaded[mid]
+                    pending = _start_chunk(prefetcher, chunks[k + 1]) if k + 1 < len(chunks) else None
+
+                    for mid in chunk:
+                        processed += 1
+                        if processed % 10 == 0 or processed == len(candidate_ids):
+                            print(f"   Processed {processed}/{len(candidate_ids)} emails...")
+                        if mid not in fetched:
+                            continue
+                        try:
+                            flight = parse_email(fetched[mid])
+                        except Exception as e:
+                            print(f"   Warning: Failed to parse message {mid}: {e}")
+                            continue
+                        yield flight
+
+        # Score how much data a record has (more = better)
+        def _richness(f):
+            return sum([
+                bool(f["Flight Number"]),
+                bool(f["From"]),
+                bool(f["To"]),
+                bool(f["Airline"]),
+                bool(f["Date"]),
+                bool(f["PNR/Booking Ref"]),
+            ])
+
+        # Filter and deduplicate in a single pass. Records are deduplicated by PNR
+        # (or flight number + date without one), keeping the one with the most data.
+        non_flight = unnamed = actual = 0
+        kept = {}
+        for i, f in enumerate(_parsed_flights()):
+            # Exclude international airlines (domestic flights only), whether named by sender or in the body
+            if f["Airline"] in EXCLUDE_AIRLINES:
+                excluded_airline += 1
+                continue
+            # Keep only actual flight bookings (must have flight number, PNR, or route)
+            if not (f["Flight Number"] or f["PNR/Booking Ref"] or (f["From"] and f["To"])):
+                non_flight += 1
+                continue
+            actual += 1
+            # Keep only bookings with passenger name, removing the internal field before writing CSV
+            if not f.pop("_has_name"):
+                unnamed += 1
+                continue
+
+            key = f["PNR/Booking Ref"] or (f["Flight Number"], f["Date"])
             if key == ("", ""):
-                deduped.append(f)
-            elif key not in seen_pnrs:
-                seen_pnrs[key] = f
-                deduped.append(f)
-            elif _richness(f) > _richness(seen_pnrs[key]):
-                deduped.remove(seen_pnrs[key])
-                seen_pnrs[key] = f
-                deduped.append(f)
-        elif pnr not in seen_pnrs:
-            seen_pnrs[pnr] = f
-            deduped.append(f)
-        elif _richness(f) > _richness(seen_pnrs[pnr]):
-            deduped.remove(seen_pnrs[pnr])
-            seen_pnrs[pnr] = f
-            deduped.append(f)
-
-    print(f"   Deduplicated to {len(deduped)} unique flights (removed {len(flights) - len(deduped)} duplicates)")
-    flights = deduped
+                # Nothing to deduplicate on: keep as-is under a key of its own
+                key = i
+            # Each record is scored once; the kept record's score is stored next to it
+            score = _richness(f)
+            current = kept.get(key)
+            if current is None:
+                kept[key] = (score, f)
+            elif score > current[0]:
+                # Re-insert so the replacement moves to the position of the newer duplicate
+                del kept[key]
+                kept[key] = (score, f)
+
+    named = actual - unnamed
+    print(f"   Excluded {excluded_subject} non-flight emails by subject")
+    print(f"   Excluded {excluded_airline} international airline emails")
+    print(f"   Filtered to {actual} actual flight records (removed {non_flight} non-flight emails)")
+    print(f"   Filtered to {named} records matching passenger name (removed {unnamed} others)")
+    print(f"   Deduplicated to {len(kept)} unique flights (removed {named - len(kept)} duplicates)")
+    flights = [f for _, f in kept.values()]
 
     # Sort by date (oldest first), empty dates go last
     flights.sort(key=lambda f: f["Date"] if f["Date"] else "9999-99-99")
@@ -626,10 +949,10 @@ def main():
         "Email Date",
     ]
 
-    with open(output_file, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(flights)
+    with open(output_file, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(map(itemgetter(*fieldnames), flights))
 
     print(f"\n4. Results saved to {output_file}")
     print(f"   Total flight emails: {len(flights)}")